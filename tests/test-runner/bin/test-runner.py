@@ -24,20 +24,67 @@ try:
 except ImportError:
     import ConfigParser as configparser
 
+# tomllib is only part of the standard library since Python 3.11
+try:
+    import tomllib
+except ImportError:
+    tomllib = None
+
+# concurrent.futures is only part of the standard library since Python 3.2
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
+
+import ast
+import errno
 import os
+import signal
+import stat
 import sys
-import ctypes
+import fcntl
+import heapq
 
 from datetime import datetime
+from functools import partial
+from operator import attrgetter
 from optparse import OptionParser
 from pwd import getpwnam
 from pwd import getpwuid
 from select import select
 from subprocess import PIPE
 from subprocess import Popen
-from threading import Timer
+from threading import RLock
+from threading import Thread
 from time import time
 
+# os.scandir() is only available since Python 3.5, so provide the subset of
+# it used by scan_tests() on top of os.listdir() for older versions.
+try:
+    from os import scandir
+except ImportError:
+    class DirEntry(object):
+        def __init__(self, dirname, name):
+            self.name = name
+            self.path = os.path.join(dirname, name)
+
+        def stat(self, follow_symlinks=True):
+            if follow_symlinks:
+                return os.stat(self.path)
+            return os.lstat(self.path)
+
+        def is_dir(self, follow_symlinks=True):
+            try:
+                return stat.S_ISDIR(self.stat(follow_symlinks).st_mode)
+            except OSError:
+                return False
+
+        def is_symlink(self):
+            return os.path.islink(self.path)
+
+    def scandir(path):
+        return [DirEntry(path, name) for name in os.listdir(path)]
+
 BASEDIR = '/var/tmp/test_results'
 TESTDIR = '/usr/share/zfs/'
 KILL = 'kill'
@@ -47,34 +94,61 @@ LOG_FILE = 'LOG_FILE'
 LOG_OUT = 'LOG_OUT'
 LOG_ERR = 'LOG_ERR'
 LOG_FILE_OBJ = None
+PROG = sys.argv[0]
+LOGNAME = getpwuid(os.getuid()).pw_name
+RESOLVED_SCRIPTS = {}
+VERIFIED_FILES = set()
+RESULTS = {0: 'PASS', 4: 'SKIP'}  # any other exit status is a FAIL
+CACHE_DIR = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+USER_CACHE = os.path.join(CACHE_DIR, 'test-runner', 'users')
+USER_CACHE_TTL = 600
+
+# Serializes logging and result accounting between tests running
+# concurrently (see -j).
+RUN_LOCK = RLock()
+
+# F_SETPIPE_SZ is only exposed by the fcntl module in Python 3.10+
+F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)  # see <linux/fcntl.h>
+PIPE_SIZE = 1 << 20
+
+# Each test runs in a new session, so that it can be killed along with
+# everything it started. preexec_fn isn't safe to use in a process with
+# threads, so only fall back to it where Popen has no start_new_session.
+if sys.version_info >= (3, 2):
+    NEW_SESSION = {'start_new_session': True}
+else:
+    NEW_SESSION = {'preexec_fn': os.setsid}
+
+# time.monotonic() is only available since Python 3.3, and some python 2.7
+# system don't have a concept of monotonic time, so use clock_gettime()
+try:
+    from time import monotonic as monotonic_time
+except ImportError:
+    import ctypes
 
-# some python 2.7 system don't have a concept of monotonic time
-CLOCK_MONOTONIC_RAW = 4  # see <linux/time.h>
-
-
-class timespec(ctypes.Structure):
-    _fields_ = [
-        ('tv_sec', ctypes.c_long),
-        ('tv_nsec', ctypes.c_long)
-    ]
-
+    CLOCK_MONOTONIC_RAW = 4  # see <linux/time.h>
 
-librt = ctypes.CDLL('librt.so.1', use_errno=True)
-clock_gettime = librt.clock_gettime
-clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    class timespec(ctypes.Structure):
+        _fields_ = [
+            ('tv_sec', ctypes.c_long),
+            ('tv_nsec', ctypes.c_long)
+        ]
 
+    librt = ctypes.CDLL('librt.so.1', use_errno=True)
+    clock_gettime = librt.clock_gettime
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
 
-def monotonic_time():
-    t = timespec()
-    if clock_gettime(CLOCK_MONOTONIC_RAW, ctypes.pointer(t)) != 0:
-        errno_ = ctypes.get_errno()
-        raise OSError(errno_, os.strerror(errno_))
-    return t.tv_sec + t.tv_nsec * 1e-9
+    def monotonic_time():
+        t = timespec()
+        if clock_gettime(CLOCK_MONOTONIC_RAW, ctypes.pointer(t)) != 0:
+            errno_ = ctypes.get_errno()
+            raise OSError(errno_, os.strerror(errno_))
+        return t.tv_sec + t.tv_nsec * 1e-9
 
 
 class Result(object):
     total = 0
-    runresults = {'PASS': 0, 'FAIL': 0, 'SKIP': 0, 'KILLED': 0, 'RERAN': 0}
+    runresults = {'PASS': 0, 'FAIL': 0, 'SKIP': 0, 'KILLED': 0}
 
     def __init__(self):
         self.starttime = None
@@ -84,28 +158,20 @@ class Result(object):
         self.stderr = []
         self.result = ''
 
-    def done(self, proc, killed, reran):
+    def done(self, proc, killed):
         """
         Finalize the results of this Cmd.
         """
-        Result.total += 1
         m, s = divmod(monotonic_time() - self.starttime, 60)
         self.runtime = '%02d:%02d' % (m, s)
         self.returncode = proc.returncode
-        if reran is True:
-            Result.runresults['RERAN'] += 1
         if killed:
             self.result = 'KILLED'
-            Result.runresults['KILLED'] += 1
-        elif self.returncode == 0:
-            self.result = 'PASS'
-            Result.runresults['PASS'] += 1
-        elif self.returncode == 4:
-            self.result = 'SKIP'
-            Result.runresults['SKIP'] += 1
-        elif self.returncode != 0:
-            self.result = 'FAIL'
-            Result.runresults['FAIL'] += 1
+        else:
+            self.result = RESULTS.get(self.returncode, 'FAIL')
+        with RUN_LOCK:
+            Result.total += 1
+            Result.runresults[self.result] += 1
 
 
 class Output(object):
@@ -113,59 +179,70 @@ class Output(object):
     This class is a slightly modified version of the 'Stream' class found
     here: http://goo.gl/aSGfv
     """
+    CHUNK = 1 << 16
+
     def __init__(self, stream):
         self.stream = stream
-        self._buf = b''
+        self._buf = bytearray()
         self.lines = []
 
     def fileno(self):
         return self.stream.fileno()
 
-    def read(self, drain=0):
+    def read(self):
         """
-        Read from the file descriptor. If 'drain' set, read until EOF.
+        Read from the file descriptor. Return False once EOF has been
+        reached, True otherwise.
         """
-        while self._read() is not None:
-            if not drain:
-                break
+        return self._read() is not None
 
     def _read(self):
         """
-        Read up to 4k of data from this output stream. Collect the output
-        up to the last newline, and append it to any leftover data from a
-        previous call. The lines are stored as a (timestamp, data) tuple
-        for easy sorting/merging later.
+        Read up to CHUNK bytes of data from this output stream. Collect
+        the output up to the last newline, and append it to any leftover
+        data from a previous call. The lines are stored as a (timestamp,
+        data) tuple for easy sorting/merging later.
         """
         fd = self.fileno()
-        buf = os.read(fd, 4096)
+        buf = os.read(fd, self.CHUNK)
         if not buf:
             return None
+        self._buf += buf
         if b'\n' not in buf:
-            self._buf += buf
             return []
 
-        buf = self._buf + buf
-        tmp, rest = buf.rsplit(b'\n', 1)
-        self._buf = rest
+        # Take the complete lines off the front of the buffer in place,
+        # leaving any trailing partial line for the next call.
+        idx = self._buf.rfind(b'\n')
+        tmp = bytes(self._buf[:idx])
+        del self._buf[:idx + 1]
         now = datetime.now()
         rows = tmp.split(b'\n')
         self.lines += [(now, r) for r in rows]
+        return rows
 
 
 class Cmd(object):
-    verified_users = []
+    verified_users = set()
+    # The warnings for users that failed verify_user(), by user name
+    rejected_users = {}
+    # (Cmd, Popen) pairs for the commands running right now, and whether
+    # the run was interrupted, so that ^C can stop the tests started by
+    # run_parallel(). Both are protected by RUN_LOCK.
+    running = set()
+    interrupted = False
 
     def __init__(self, pathname, outputdir=None, timeout=None, user=None,
                  tags=None):
         self.pathname = pathname
         self.outputdir = outputdir or 'BASEDIR'
         """
-        The timeout for tests is measured in wall-clock time
+        The timeout for tests is measured on the monotonic clock, which
+        doesn't advance while the system is suspended
         """
         self.timeout = timeout
         self.user = user or ''
         self.killed = False
-        self.reran = None
         self.result = Result()
 
         if self.timeout is None:
@@ -175,38 +252,26 @@ class Cmd(object):
         return "Pathname: %s\nOutputdir: %s\nTimeout: %d\nUser: %s\n" % \
             (self.pathname, self.outputdir, self.timeout, self.user)
 
-    def kill_cmd(self, proc, keyboard_interrupt=False):
+    def kill_cmd(self, proc):
         """
-        Kill a running command due to timeout, or ^C from the keyboard. If
-        sudo is required, this user was verified previously.
+        Kill a running command due to timeout, or ^C from the keyboard.
+        Each command leads its own process group, so signal the whole group
+        to take down anything it started as well. If that is not permitted
+        because the command runs as another user, use sudo; this user was
+        verified previously.
         """
         self.killed = True
-        do_sudo = len(self.user) != 0
-        signal = '-TERM'
-
-        cmd = [SUDO, KILL, signal, str(proc.pid)]
-        if not do_sudo:
-            del cmd[0]
 
         try:
-            kp = Popen(cmd)
-            kp.wait()
-        except Exception:
-            pass
-
-        """
-        If this is not a user-initiated kill and the test has not been
-        reran before we consider if the test needs to be reran:
-        If the test has spent some time hibernating and didn't run the whole
-        length of time before being timed out we will rerun the test.
-        """
-        if keyboard_interrupt is False and self.reran is None:
-            runtime = monotonic_time() - self.result.starttime
-            if int(self.timeout) > runtime:
-                self.killed = False
-                self.reran = False
-                self.run(False)
-                self.reran = True
+            os.killpg(proc.pid, signal.SIGTERM)
+        except OSError as e:
+            if e.errno != errno.EPERM or not len(self.user):
+                return
+            try:
+                kp = Popen([SUDO, KILL, '-TERM', '--', '-%d' % proc.pid])
+                kp.wait()
+            except Exception:
+                pass
 
     def update_cmd_privs(self, cmd, user):
         """
@@ -214,40 +279,84 @@ class Cmd(object):
         running as that user, prepend the appropriate sudo command to run
         as that user.
         """
-        me = getpwuid(os.getuid())
+        cmd = resolve_script(cmd) or cmd
 
-        if not user or user is me:
-            if os.path.isfile(cmd+'.ksh') and os.access(cmd+'.ksh', os.X_OK):
-                cmd += '.ksh'
-            if os.path.isfile(cmd+'.sh') and os.access(cmd+'.sh', os.X_OK):
-                cmd += '.sh'
+        if not user or user == LOGNAME:
             return cmd
 
-        if not os.path.isfile(cmd):
-            if os.path.isfile(cmd+'.ksh') and os.access(cmd+'.ksh', os.X_OK):
-                cmd += '.ksh'
-            if os.path.isfile(cmd+'.sh') and os.access(cmd+'.sh', os.X_OK):
-                cmd += '.sh'
+        return [SUDO, '-E', '-u', user, cmd]
+
+    @classmethod
+    def interrupt_cmds(cls):
+        """
+        Stop the run on ^C: kill every command that is running, and keep
+        any more from being started.
+        """
+        with RUN_LOCK:
+            cls.interrupted = True
+            for cmd, proc in list(cls.running):
+                cmd.kill_cmd(proc)
 
-        ret = '%s -E -u %s %s' % (SUDO, user, cmd)
-        return ret.split(' ')
+    @staticmethod
+    def reap(proc, wakefd):
+        """
+        Wait for the process to exit, then close the write end of the
+        wakeup pipe so that collect_output() sees it become readable.
+        """
+        proc.wait()
+        os.close(wakefd)
 
-    def collect_output(self, proc):
+    def collect_output(self, proc, deadline=None):
         """
         Read from stdout/stderr as data becomes available, until the
-        process is no longer running. Return the lines from the stdout and
+        process is no longer running. Rather than polling, select() also
+        waits on a pidfd for the process, which becomes readable when it
+        exits, so a quiet test costs no wakeups. Where pidfds aren't
+        available, a helper thread reaps the process and wakes up select()
+        through a pipe instead. If the process is still running at the
+        monotonic 'deadline', kill it. Return the lines from the stdout and
         stderr Output objects.
         """
         out = Output(proc.stdout)
         err = Output(proc.stderr)
-        res = []
-        while proc.returncode is None:
-            proc.poll()
-            res = select([out, err], [], [], .1)
-            for fd in res[0]:
-                fd.read()
-        for fd in res[0]:
-            fd.read(drain=1)
+        reaper = None
+        try:
+            # Python 3.9+ on Linux 5.3+
+            wake = os.pidfd_open(proc.pid)
+        except (AttributeError, OSError):
+            wake, wake_w = os.pipe()
+            reaper = Thread(target=Cmd.reap, args=(proc, wake_w))
+            reaper.daemon = True
+            reaper.start()
+
+        fds = [out, err, wake]
+        while fds:
+            if wake not in fds:
+                # The process has exited, drain what it left behind.
+                timeout = 0
+            elif deadline is not None:
+                timeout = max(deadline - monotonic_time(), 0)
+            else:
+                timeout = None
+
+            ready = select(fds, [], [], timeout)[0]
+            if not ready:
+                if wake not in fds:
+                    break
+                self.kill_cmd(proc)
+                deadline = None
+
+            for fd in ready:
+                if fd == wake:
+                    if reaper is None:
+                        proc.wait()
+                    fds.remove(fd)
+                elif not fd.read():
+                    fds.remove(fd)
+
+        if reaper is not None:
+            reaper.join()
+        os.close(wake)
 
         return out.lines, err.lines
 
@@ -263,39 +372,56 @@ class Cmd(object):
 
         privcmd = self.update_cmd_privs(self.pathname, self.user)
         try:
-            old = os.umask(0)
-            if not os.path.isdir(self.outputdir):
-                os.makedirs(self.outputdir, mode=0o777)
-            os.umask(old)
+            make_output_dir(self.outputdir)
         except OSError as e:
             fail('%s' % e)
 
+        # Don't start anything new once a parallel run was interrupted
+        if Cmd.interrupted:
+            raise KeyboardInterrupt
+
         self.result.starttime = monotonic_time()
-        proc = Popen(privcmd, stdout=PIPE, stderr=PIPE)
+        proc = Popen(privcmd, stdout=PIPE, stderr=PIPE, **NEW_SESSION)
+        with RUN_LOCK:
+            Cmd.running.add((self, proc))
+            # We may have been started just as the run was interrupted,
+            # too late for interrupt_cmds() to see us.
+            if Cmd.interrupted:
+                self.kill_cmd(proc)
+        # Enlarge the pipes so a chatty test blocks less often on a full
+        # pipe. This is only an optimization, so ignore any failure.
+        for stream in proc.stdout, proc.stderr:
+            try:
+                fcntl.fcntl(stream.fileno(), F_SETPIPE_SZ, PIPE_SIZE)
+            except (IOError, OSError):
+                pass
         # Allow a special timeout value of 0 to mean infinity
         if int(self.timeout) == 0:
             self.timeout = sys.maxsize
-        t = Timer(int(self.timeout), self.kill_cmd, [proc])
+        deadline = None
+        if self.timeout != sys.maxsize:
+            deadline = self.result.starttime + int(self.timeout)
 
         try:
-            t.start()
-            self.result.stdout, self.result.stderr = self.collect_output(proc)
+            self.result.stdout, self.result.stderr = \
+                self.collect_output(proc, deadline)
         except KeyboardInterrupt:
-            self.kill_cmd(proc, True)
+            self.kill_cmd(proc)
             fail('\nRun terminated at user request.')
         finally:
-            t.cancel()
+            with RUN_LOCK:
+                Cmd.running.discard((self, proc))
 
-        if self.reran is not False:
-            self.result.done(proc, self.killed, self.reran)
+        self.result.done(proc, self.killed)
 
     def skip(self):
         """
         Initialize enough of the test result that we can log a skipped
         command.
         """
-        Result.total += 1
-        Result.runresults['SKIP'] += 1
+        with RUN_LOCK:
+            Result.total += 1
+            Result.runresults['SKIP'] += 1
         self.result.stdout = self.result.stderr = []
         self.result.starttime = monotonic_time()
         m, s = divmod(monotonic_time() - self.result.starttime, 60)
@@ -310,52 +436,69 @@ class Cmd(object):
         stdout/stderr/merged in its own file.
         """
 
-        logname = getpwuid(os.getuid()).pw_name
-        rer = ''
-        if self.reran is True:
-            rer = ' (RERAN)'
-        user = ' (run as %s)' % (self.user if len(self.user) else logname)
+        user = ' (run as %s)' % (self.user if len(self.user) else LOGNAME)
         msga = 'Test: %s%s ' % (self.pathname, user)
-        msgb = '[%s] [%s]%s\n' % (self.result.runtime, self.result.result, rer)
+        msgb = '[%s] [%s]\n' % (self.result.runtime, self.result.result)
         pad = ' ' * (80 - (len(msga) + len(msgb)))
         result_line = msga + pad + msgb
 
-        # The result line is always written to the log file. If -q was
-        # specified only failures are written to the console, otherwise
-        # the result line is written to the console.
-        write_log(bytearray(result_line, encoding='utf-8'), LOG_FILE)
-        if not options.quiet:
-            write_log(result_line, LOG_OUT)
-        elif options.quiet and self.result.result != 'PASS':
-            write_log(result_line, LOG_OUT)
-
-        lines = sorted(self.result.stdout + self.result.stderr,
-                       key=lambda x: x[0])
-
-        # Write timestamped output (stdout and stderr) to the logfile
-        for dt, line in lines:
-            timestamp = bytearray(dt.strftime("%H:%M:%S.%f ")[:11],
-                                  encoding='utf-8')
-            write_log(b'%s %s\n' % (timestamp, line), LOG_FILE)
+        # Hold the lock so the output of concurrently running tests is not
+        # interleaved in the logfile.
+        with RUN_LOCK:
+            # The result line is always written to the log file. If -q was
+            # specified only failures are written to the console, otherwise
+            # the result line is written to the console.
+            write_log(result_line, LOG_FILE)
+            if not options.quiet:
+                write_log(result_line, LOG_OUT)
+            elif options.quiet and self.result.result != 'PASS':
+                write_log(result_line, LOG_OUT)
+
+            # Most tests that pass are silent, leaving nothing else to do.
+            if not self.result.stdout and not self.result.stderr:
+                LOG_FILE_OBJ.flush()
+                return
+
+            lines = list(merge_output(self.result.stdout, self.result.stderr))
+
+            # Write timestamped output (stdout and stderr) to the logfile,
+            # assembled up front so that it takes a single write.
+            # Lines collected by the same read share their timestamp, so
+            # only format it when it changes.
+            chunks = []
+            last = None
+            for dt, line in lines:
+                if dt is not last:
+                    last = dt
+                    timestamp = b'%02d:%02d:%02d.%02d' % (
+                        dt.hour, dt.minute, dt.second, dt.microsecond // 10000)
+                chunks.append(b'%s %s\n' % (timestamp, line))
+            if chunks:
+                write_log(b''.join(chunks), LOG_FILE)
+            # The logfile is buffered, flush it once per test so that
+            # anyone following it still sees the run progress.
+            LOG_FILE_OBJ.flush()
 
         # Write the separate stdout/stderr/merged files, if the data exists
         if len(self.result.stdout):
             with open(os.path.join(self.outputdir, 'stdout'), 'wb') as out:
-                for _, line in self.result.stdout:
-                    os.write(out.fileno(), b'%s\n' % line)
+                out.write(b'\n'.join([line for _, line in self.result.stdout]))
+                out.write(b'\n')
         if len(self.result.stderr):
             with open(os.path.join(self.outputdir, 'stderr'), 'wb') as err:
-                for _, line in self.result.stderr:
-                    os.write(err.fileno(), b'%s\n' % line)
+                err.write(b'\n'.join([line for _, line in self.result.stderr]))
+                err.write(b'\n')
         if len(self.result.stdout) and len(self.result.stderr):
             with open(os.path.join(self.outputdir, 'merged'), 'wb') as merged:
-                for _, line in lines:
-                    os.write(merged.fileno(), b'%s\n' % line)
+                merged.write(b'\n'.join([line for _, line in lines]))
+                merged.write(b'\n')
 
 
 class Test(Cmd):
     props = ['outputdir', 'timeout', 'user', 'pre', 'pre_user', 'post',
              'post_user', 'tags']
+    # Fetches all of the above from an object in a single call
+    get_props = attrgetter(*props)
 
     def __init__(self, pathname, outputdir=None, timeout=None, user=None,
                  pre=None, pre_user=None, post=None, post_user=None,
@@ -505,7 +648,7 @@ class TestGroup(Test):
         script regardless.
         """
         # tags assigned to this test group also include the test names
-        if options.tags and not set(self.tags).intersection(set(options.tags)):
+        if options.tags and options.tag_set.isdisjoint(self.tags):
             return
 
         odir = os.path.join(self.outputdir, os.path.basename(self.pre))
@@ -569,15 +712,19 @@ class TestRun(object):
             s += '%s%s' % (self.testgroups[key].__str__(), '\n')
         return s
 
-    def addtest(self, pathname, options):
+    def addtest(self, pathname, options, prefetched_stat=None):
         """
         Create a new Test, and apply any properties that were passed in
         from the command line. If it passes verification, add it to the
-        TestRun.
+        TestRun. If the caller already has the lstat() result for the
+        pathname, it can be passed in to save verifying it again.
         """
+        if prefetched_stat is not None:
+            note_stat(pathname, prefetched_stat)
+
         test = Test(pathname)
-        for prop in Test.props:
-            setattr(test, prop, getattr(options, prop))
+        for prop, value in zip(Test.props, Test.get_props(options)):
+            setattr(test, prop, value)
 
         if test.verify():
             self.tests[pathname] = test
@@ -586,12 +733,19 @@ class TestRun(object):
         """
         Create a new TestGroup, and apply any properties that were passed
         in from the command line. If it passes verification, add it to the
-        TestRun.
+        TestRun. The filenames may also be DirEntry objects from
+        scan_tests(), in which case their stat() results are used to verify
+        the tests.
         """
+        if filenames and not isinstance(filenames[0], str):
+            for entry in filenames:
+                note_executable(entry)
+            filenames = [entry.name for entry in filenames]
+
         if dirname not in self.testgroups:
             testgroup = TestGroup(dirname)
-            for prop in Test.props:
-                setattr(testgroup, prop, getattr(options, prop))
+            for prop, value in zip(Test.props, Test.get_props(options)):
+                setattr(testgroup, prop, value)
 
             # Prevent pre/post scripts from running as regular tests
             for f in [testgroup.pre, testgroup.post]:
@@ -612,17 +766,21 @@ class TestRun(object):
         in the 'DEFAULT' section. If the Test or TestGroup passes
         verification, add it to the TestRun.
         """
-        config = configparser.RawConfigParser()
-        if not len(config.read(options.runfile)):
-            fail("Coulnd't read config file %s" % options.runfile)
+        if options.runfile.endswith('.toml'):
+            sections = self.read_toml(options)
+        else:
+            sections = self.read_ini(options)
+        defaults = sections.pop('DEFAULT', {})
 
         for opt in TestRun.props:
-            if config.has_option('DEFAULT', opt):
-                setattr(self, opt, config.get('DEFAULT', opt))
+            if opt in defaults:
+                setattr(self, opt, defaults[opt])
         self.outputdir = os.path.join(self.outputdir, self.timestamp)
 
-        for section in config.sections():
-            if 'tests' in config.options(section):
+        for section, values in sections.items():
+            props = dict(defaults)
+            props.update(values)
+            if 'tests' in props:
                 if os.path.isdir(section):
                     pathname = section
                 elif os.path.isdir(os.path.join(options.testdir, section)):
@@ -632,30 +790,83 @@ class TestRun(object):
 
                 testgroup = TestGroup(os.path.abspath(pathname))
                 for prop in TestGroup.props:
-                    for sect in ['DEFAULT', section]:
-                        if config.has_option(sect, prop):
-                            if prop == "tags":
-                                setattr(testgroup, prop,
-                                        eval(config.get(sect, prop)))
-                            else:
-                                setattr(testgroup, prop,
-                                        config.get(sect, prop))
-
-                # Repopulate tests using eval to convert the string to a list
-                testgroup.tests = eval(config.get(section, 'tests'))
+                    if prop in props:
+                        setattr(testgroup, prop, props[prop])
 
                 if testgroup.verify():
                     self.testgroups[section] = testgroup
             else:
                 test = Test(section)
                 for prop in Test.props:
-                    for sect in ['DEFAULT', section]:
-                        if config.has_option(sect, prop):
-                            setattr(test, prop, config.get(sect, prop))
+                    if prop in props:
+                        setattr(test, prop, props[prop])
 
                 if test.verify():
                     self.tests[section] = test
 
+    def read_ini(self, options):
+        """
+        Parse an ini style runfile into a dictionary of sections, each a
+        dictionary of properties. The 'tests' and 'tags' lists are written
+        as Python literals, so convert them with ast.literal_eval().
+        """
+        config = configparser.RawConfigParser()
+        if not len(config.read(options.runfile)):
+            fail("Coulnd't read config file %s" % options.runfile)
+
+        sections = {'DEFAULT': dict(config.defaults())}
+        for section in config.sections():
+            sections[section] = dict(config.items(section))
+
+        for section, values in sections.items():
+            for prop in ['tests', 'tags']:
+                if prop in values:
+                    value = values[prop].strip()
+                    try:
+                        values[prop] = ast.literal_eval(value) if value else []
+                    except (SyntaxError, ValueError):
+                        fail("%s: '%s' in section '%s' is not a valid list." %
+                             (options.runfile, prop, section))
+            self.check_section(options, section, values)
+
+        return sections
+
+    def read_toml(self, options):
+        """
+        Parse a TOML runfile, whose tables map directly onto the sections
+        of an ini style runfile but hold natively typed values. Those types
+        aren't enforced by the parser, so check the ones we rely on.
+        """
+        if tomllib is None:
+            fail('Reading %s requires Python 3.11 or later.' % options.runfile)
+
+        try:
+            with open(options.runfile, 'rb') as f:
+                sections = tomllib.load(f)
+        except (IOError, OSError, tomllib.TOMLDecodeError) as e:
+            fail("Couldn't read config file %s: %s" % (options.runfile, e))
+
+        for section, values in sections.items():
+            if not isinstance(values, dict):
+                fail("%s: '%s' must be set in a section." %
+                     (options.runfile, section))
+            self.check_section(options, section, values)
+
+        return sections
+
+    def check_section(self, options, section, values):
+        """
+        Fail unless the 'tests' and 'tags' of a runfile section, if set,
+        are lists of strings.
+        """
+        for prop in ['tests', 'tags']:
+            if prop not in values:
+                continue
+            if not isinstance(values[prop], list) or \
+                    not all(isinstance(x, str) for x in values[prop]):
+                fail("%s: '%s' in section '%s' must be a list of strings." %
+                     (options.runfile, prop, section))
+
     def write(self, options):
         """
         Create a configuration file for editing and later use. The
@@ -685,8 +896,8 @@ class TestRun(object):
 
     def complete_outputdirs(self):
         """
-        Collect all the pathnames for Tests, and TestGroups. Work
-        backwards one pathname component at a time, to create a unique
+        Collect all the pathnames for Tests, and TestGroups. Strip the
+        leading directories they all have in common, to create a unique
         directory name in which to deposit test output. Tests will be able
         to write output files directly in the newly modified outputdir.
         TestGroups will be able to create one subdirectory per test in the
@@ -695,24 +906,18 @@ class TestRun(object):
         directory rooted at the outputdir of the Test or TestGroup in
         question for their output.
         """
-        done = False
-        components = 0
         tmp_dict = dict(list(self.tests.items()) +
                         list(self.testgroups.items()))
-        total = len(tmp_dict)
+        components = dict([(testfile, testfile.split('/')) for testfile in
+                           tmp_dict])
+        # commonprefix() compares lists element by element, so this is the
+        # longest run of leading directories shared by every pathname.
+        common = os.path.commonprefix([c[:-1] for c in components.values()])
         base = self.outputdir
 
-        while not done:
-            paths = []
-            components -= 1
-            for testfile in list(tmp_dict.keys()):
-                uniq = '/'.join(testfile.split('/')[components:]).lstrip('/')
-                if uniq not in paths:
-                    paths.append(uniq)
-                    tmp_dict[testfile].outputdir = os.path.join(base, uniq)
-                else:
-                    break
-            done = total == len(paths)
+        for testfile, obj in tmp_dict.items():
+            uniq = '/'.join(components[testfile][len(common):]).lstrip('/')
+            obj.outputdir = os.path.join(base, uniq)
 
     def setup_logging(self, options):
         """
@@ -730,7 +935,7 @@ class TestRun(object):
                 os.makedirs(self.outputdir, mode=0o777)
                 os.umask(old)
                 filename = os.path.join(self.outputdir, 'log')
-                LOG_FILE_OBJ = open(filename, buffering=0, mode='wb')
+                LOG_FILE_OBJ = open(filename, buffering=1 << 16, mode='wb')
             except OSError as e:
                 fail('%s' % e)
 
@@ -751,14 +956,48 @@ class TestRun(object):
         else:
             write_log('Could not make a symlink to directory %s\n' %
                       self.outputdir, LOG_ERR)
+        runnables = [self.tests[test] for test in sorted(self.tests.keys())]
+        runnables += [self.testgroups[testgroup] for testgroup in
+                      sorted(self.testgroups.keys())]
         iteration = 0
         while iteration < options.iterations:
-            for test in sorted(self.tests.keys()):
-                self.tests[test].run(options)
-            for testgroup in sorted(self.testgroups.keys()):
-                self.testgroups[testgroup].run(options)
+            if options.jobs > 1:
+                self.run_parallel(runnables, options)
+            else:
+                for runnable in runnables:
+                    runnable.run(options)
             iteration += 1
 
+    def run_parallel(self, runnables, options):
+        """
+        Run the Tests and TestGroups on a pool of options.jobs threads.
+        Those tagged 'serial' need the system to themselves, so they are
+        held back and run one at a time once all the others are done.
+        """
+        concurrent = [r for r in runnables if 'serial' not in r.tags]
+        serial = [r for r in runnables if 'serial' in r.tags]
+
+        pool = ThreadPoolExecutor(options.jobs)
+        futures = [pool.submit(r.run, options) for r in concurrent]
+        try:
+            # ^C is only ever delivered to this thread, and errors from the
+            # others only surface here, so stop the remaining tests from
+            # here too.
+            for future in futures:
+                future.result()
+        except BaseException as e:
+            for future in futures:
+                future.cancel()
+            Cmd.interrupt_cmds()
+            pool.shutdown()
+            if isinstance(e, KeyboardInterrupt):
+                fail('\nRun terminated at user request.')
+            raise
+        pool.shutdown()
+
+        for runnable in serial:
+            runnable.run(options)
+
     def summary(self):
         if Result.total == 0:
             return 2
@@ -781,71 +1020,207 @@ class TestRun(object):
         if Result.runresults['KILLED'] > 0:
             return 1
 
-        if Result.runresults['RERAN'] > 0:
-            return 3
-
         return 0
 
 
 def write_log(msg, target):
     """
     Write the provided message to standard out, standard error or
-    the logfile. If specifying LOG_FILE, then `msg` must be a bytes
-    like object. This way we can still handle output from tests that
-    may be in unexpected encodings.
+    the logfile. `msg` may be a string, which is encoded as UTF-8, or a
+    bytes like object, which is written as is. This way we can still
+    handle output from tests that may be in unexpected encodings.
     """
-    if target == LOG_OUT:
-        os.write(sys.stdout.fileno(), bytearray(msg, encoding='utf-8'))
-    elif target == LOG_ERR:
-        os.write(sys.stderr.fileno(), bytearray(msg, encoding='utf-8'))
-    elif target == LOG_FILE:
-        os.write(LOG_FILE_OBJ.fileno(), msg)
-    else:
-        fail('log_msg called with unknown target "%s"' % target)
+    if not isinstance(msg, (bytes, bytearray)):
+        msg = msg.encode('utf-8')
+
+    with RUN_LOCK:
+        if target == LOG_OUT:
+            os.write(sys.stdout.fileno(), msg)
+        elif target == LOG_ERR:
+            os.write(sys.stderr.fileno(), msg)
+        elif target == LOG_FILE:
+            LOG_FILE_OBJ.write(msg)
+        else:
+            fail('log_msg called with unknown target "%s"' % target)
+
+
+def merge_output(stdout, stderr):
+    """
+    Merge the (timestamp, data) tuples collected from stdout and stderr.
+    Each is already in time order, so a single merge pass is enough and
+    there is no need to sort them all over again.
+    """
+    try:
+        return heapq.merge(stdout, stderr, key=lambda x: x[0])
+    except TypeError:
+        # heapq.merge() only accepts a key since Python 3.5
+        return sorted(stdout + stderr, key=lambda x: x[0])
+
+
+def make_output_dir(dirname):
+    """
+    Create dirname and any missing parents with mode 0777, as setting the
+    umask to 0 around os.makedirs() would. The umask is process wide, so
+    changing it would also affect the files created by tests running
+    concurrently (see -j).
+    """
+    if os.path.isdir(dirname):
+        return
+
+    parent = os.path.dirname(dirname)
+    if parent != dirname:
+        make_output_dir(parent)
+
+    try:
+        os.mkdir(dirname)
+    except OSError as e:
+        # Another test may have just created it
+        if e.errno == errno.EEXIST and os.path.isdir(dirname):
+            return
+        raise
+    os.chmod(dirname, 0o777)
 
 
 def verify_file(pathname):
     """
     Verify that the supplied pathname is an executable regular file.
     """
+    if pathname in VERIFIED_FILES:
+        return True
+
     if os.path.isdir(pathname) or os.path.islink(pathname):
         return False
 
+    return resolve_script(pathname) is not None
+
+
+def resolve_script(pathname):
+    """
+    Return the executable regular file to run for the supplied pathname,
+    trying it as is, then with a '.ksh' and a '.sh' extension, or None if
+    there is no such file. The same scripts are looked up repeatedly while
+    verifying and running tests, so the answers are cached.
+    """
+    if pathname in RESOLVED_SCRIPTS:
+        return RESOLVED_SCRIPTS[pathname]
+
+    script = None
     for ext in '', '.ksh', '.sh':
         script_path = pathname + ext
         if os.path.isfile(script_path) and os.access(script_path, os.X_OK):
-            return True
+            script = script_path
+            break
 
-    return False
+    RESOLVED_SCRIPTS[pathname] = script
+    return script
+
+
+def note_executable(entry):
+    """
+    Record a DirEntry that is an executable regular file as verified, so
+    that verify_file() and resolve_script() don't have to look it up
+    again. The lstat() result is usually already cached in the DirEntry
+    by scandir().
+    """
+    try:
+        note_stat(entry.path, entry.stat(follow_symlinks=False))
+    except OSError:
+        pass
+
+
+def note_stat(pathname, st):
+    """
+    Record pathname as verified if st, the result of lstat() on it, shows
+    a regular file that we may execute. The mode bits alone don't say
+    whether they apply to us, or whether the filesystem allows execution,
+    so leave that to access().
+    """
+    mode = st.st_mode
+    if stat.S_ISREG(mode) and mode & (stat.S_IXUSR | stat.S_IXGRP |
+                                      stat.S_IXOTH) and \
+            os.access(pathname, os.X_OK):
+        VERIFIED_FILES.add(pathname)
+        RESOLVED_SCRIPTS[pathname] = pathname
 
 
 def verify_user(user):
     """
     Verify that the specified user exists on this system, and can execute
-    sudo without being prompted for a password.
+    sudo without being prompted for a password. The answer is remembered
+    either way, so sudo is only probed once per user.
     """
-    testcmd = [SUDO, '-n', '-u', user, TRUE]
-
     if user in Cmd.verified_users:
         return True
 
+    if user in Cmd.rejected_users:
+        write_log(Cmd.rejected_users[user], LOG_ERR)
+        return False
+
+    testcmd = [SUDO, '-n', '-u', user, TRUE]
+
     try:
         getpwnam(user)
     except KeyError:
-        write_log("Warning: user '%s' does not exist.\n" % user,
-                  LOG_ERR)
-        return False
-
-    p = Popen(testcmd)
-    p.wait()
-    if p.returncode != 0:
-        write_log("Warning: user '%s' cannot use passwordless sudo.\n" % user,
-                  LOG_ERR)
-        return False
+        warning = "Warning: user '%s' does not exist.\n" % user
     else:
-        Cmd.verified_users.append(user)
+        p = Popen(testcmd)
+        p.wait()
+        if p.returncode == 0:
+            Cmd.verified_users.add(user)
+            save_verified_user(user)
+            return True
+        warning = "Warning: user '%s' cannot use passwordless sudo.\n" % user
+
+    Cmd.rejected_users[user] = warning
+    write_log(warning, LOG_ERR)
+    return False
 
-    return True
+
+def load_verified_users():
+    """
+    Seed Cmd.verified_users from the users verified by recent runs, so
+    that re-running tests does not probe sudo all over again. Each user is
+    recorded with the time it was verified, and is forgotten once that is
+    more than USER_CACHE_TTL seconds ago. The expired entries are dropped
+    from the cache so that it doesn't keep growing.
+    """
+    now = time()
+    try:
+        with open(USER_CACHE) as f:
+            lines = f.readlines()
+    except (IOError, OSError):
+        return
+
+    current = []
+    for line in lines:
+        try:
+            verified, user = line.split()
+            if now - float(verified) <= USER_CACHE_TTL:
+                Cmd.verified_users.add(user)
+                current.append(line)
+        except ValueError:
+            pass
+
+    if len(current) != len(lines):
+        try:
+            with open(USER_CACHE, 'w') as f:
+                f.writelines(current)
+        except (IOError, OSError):
+            pass
+
+
+def save_verified_user(user):
+    """
+    Record a verified user in the cache read by load_verified_users(). The
+    cache is only an optimization, so failing to write it is not an error.
+    """
+    try:
+        if not os.path.isdir(os.path.dirname(USER_CACHE)):
+            os.makedirs(os.path.dirname(USER_CACHE))
+        with open(USER_CACHE, 'a') as f:
+            f.write('%d %s\n' % (time(), user))
+    except (IOError, OSError):
+        pass
 
 
 def find_tests(testrun, options):
@@ -854,44 +1229,117 @@ def find_tests(testrun, options):
     if do_groups is True, add the directory as a TestGroup. If False,
     recursively search for executable files.
     """
+    # Scanning is mostly spent waiting on the filesystem, so scan several
+    # pathnames at once when we can, then add the tests in order.
+    pathnames = options.pathnames
+    if ThreadPoolExecutor is not None and len(pathnames) > 1:
+        pool = ThreadPoolExecutor(min(32, len(pathnames)))
+        try:
+            scans = list(pool.map(scan_pathname, pathnames))
+        finally:
+            pool.shutdown()
+    else:
+        scans = [scan_pathname(p) for p in pathnames]
+
+    for p, (st, dirs) in zip(pathnames, scans):
+        if dirs is None:
+            testrun.addtest(p, options, prefetched_stat=st)
+            continue
+
+        for dirname, entries in dirs:
+            if options.do_groups:
+                # Leave out hidden files, and directories with no tests
+                entries = [e for e in entries if not e.name.startswith('.')]
+                if entries:
+                    testrun.addtestgroup(dirname, entries, options)
+            else:
+                for entry in entries:
+                    note_executable(entry)
+                    testrun.addtest(entry.path, options)
+
+
+def scan_pathname(p):
+    """
+    Return the lstat() result for a pathname given on the command line, or
+    None if it doesn't exist, along with the list of scan_tests() results
+    if it is a directory, or None otherwise. The lstat() results of the
+    files found are fetched here too, so they are cached in the DirEntry
+    objects by the time the tests are verified.
+    """
+    # One lstat() tells directories from files, and is reused to verify
+    # the files. Only a symbolic link needs a second look, since like
+    # os.path.isdir() we follow a link to a directory named here.
+    try:
+        st = os.lstat(p)
+    except OSError:
+        return None, None
 
-    for p in sorted(options.pathnames):
-        if os.path.isdir(p):
-            for dirname, _, filenames in os.walk(p):
-                if options.do_groups:
-                    testrun.addtestgroup(dirname, filenames, options)
-                else:
-                    for f in sorted(filenames):
-                        testrun.addtest(os.path.join(dirname, f), options)
-        else:
-            testrun.addtest(p, options)
+    if not (stat.S_ISDIR(st.st_mode) or
+            stat.S_ISLNK(st.st_mode) and os.path.isdir(p)):
+        return st, None
+
+    dirs = list(scan_tests(p))
+    for dirname, entries in dirs:
+        for entry in entries:
+            try:
+                entry.stat(follow_symlinks=False)
+            except OSError:
+                pass
+
+    return st, dirs
+
+
+def scan_tests(dirname):
+    """
+    Walk the tree below dirname like os.walk(), yielding each directory
+    name along with a sorted list of the DirEntry objects for the files
+    in it. The file type of each entry comes from readdir(), so telling
+    files and directories apart doesn't need a stat() of every entry.
+    """
+    try:
+        entries = list(scandir(dirname))
+    except OSError:
+        return
+    entries.sort(key=attrgetter('name'))
+
+    # Like os.walk(), don't descend into symbolic links to directories
+    files = []
+    subdirs = []
+    for entry in entries:
+        if not entry.is_dir():
+            files.append(entry)
+        elif not entry.is_symlink():
+            subdirs.append(entry)
+
+    yield dirname, files
+
+    for entry in subdirs:
+        for result in scan_tests(entry.path):
+            yield result
 
 
 def fail(retstr, ret=1):
-    print('%s: %s' % (sys.argv[0], retstr))
-    exit(ret)
+    sys.stderr.write('%s: %s\n' % (PROG, retstr))
+    sys.exit(ret)
 
 
-def options_cb(option, opt_str, value, parser):
-    path_options = ['runfile', 'outputdir', 'template', 'testdir']
+def abspath_from(cwd, path):
+    """
+    Like os.path.abspath(), but relative to the supplied working directory
+    so that converting many paths only calls getcwd() once.
+    """
+    return os.path.normpath(os.path.join(cwd, path))
 
-    if option.dest == 'runfile' and '-w' in parser.rargs or \
-            option.dest == 'template' and '-c' in parser.rargs:
-        fail('-c and -w are mutually exclusive.')
 
-    if opt_str in parser.rargs:
+def options_cb(option, opt_str, value, parser):
+    seen = getattr(parser.values, '_seen_opts', None)
+    if seen is None:
+        seen = parser.values._seen_opts = set()
+    if opt_str in seen:
         fail('%s may only be specified once.' % opt_str)
-
-    if option.dest == 'runfile':
-        parser.values.cmd = 'rdconfig'
-    if option.dest == 'template':
-        parser.values.cmd = 'wrconfig'
-    if option.dest == 'tags':
-        value = [x.strip() for x in value.split(',')]
+    seen.add(opt_str)
 
     setattr(parser.values, option.dest, value)
-    if option.dest in path_options:
-        setattr(parser.values, option.dest, os.path.abspath(value))
 
 
 def parse_args():
@@ -938,21 +1386,48 @@ def parse_args():
     parser.add_option('-I', action='callback', callback=options_cb, default=1,
                       dest='iterations', metavar='iterations', type='int',
                       help='Number of times to run the test run.')
+    parser.add_option('-j', action='callback', callback=options_cb, default=1,
+                      dest='jobs', metavar='jobs', type='int',
+                      help='Number of tests or test groups to run at once.')
     (options, pathnames) = parser.parse_args()
 
-    if not options.runfile and not options.template:
+    if options.runfile and options.template:
+        fail('-c and -w are mutually exclusive.')
+
+    if options.runfile:
+        options.cmd = 'rdconfig'
+    elif options.template:
+        options.cmd = 'wrconfig'
+    else:
         options.cmd = 'runtests'
 
+    cwd = os.getcwd()
+    for opt in ['runfile', 'outputdir', 'template', 'testdir']:
+        if getattr(options, opt):
+            setattr(options, opt, abspath_from(cwd, getattr(options, opt)))
+
+    if options.tags:
+        options.tags = [x.strip() for x in options.tags.split(',')]
+    # TestGroups are matched against the tags as they run, so build the set
+    # to test against once here.
+    options.tag_set = frozenset(options.tags or [])
+
     if options.runfile and len(pathnames):
         fail('Extraneous arguments.')
 
-    options.pathnames = [os.path.abspath(path) for path in pathnames]
+    if options.jobs < 1:
+        fail('-j requires a positive number of jobs.')
+    if options.jobs > 1 and ThreadPoolExecutor is None:
+        fail('-j requires the concurrent.futures module.')
+
+    options.pathnames = sorted(map(partial(abspath_from, cwd), pathnames))
 
     return options
 
 
 def main():
     options = parse_args()
+    load_verified_users()
     testrun = TestRun(options)
 
     if options.cmd == 'runtests':
@@ -962,13 +1437,13 @@ def main():
     elif options.cmd == 'wrconfig':
         find_tests(testrun, options)
         testrun.write(options)
-        exit(0)
+        sys.exit(0)
     else:
         fail('Unknown command specified')
 
     testrun.complete_outputdirs()
     testrun.run(options)
-    exit(testrun.summary())
+    sys.exit(testrun.summary())
 
 
 if __name__ == '__main__':